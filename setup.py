@@ -30,7 +30,7 @@ requires = [
     'python-daemon>=1.5.5',
     'python-dateutil>=2.1',
     'sqla_mixins>=0.6',
-    'sqlalchemy>=0.7.8',
+    'sqlalchemy>=1.2',
     'zope.sqlalchemy>=0.7.1',
     'PyYAML']
 
@@ -1,11 +1,13 @@
 from pyramid.authentication import AuthTktAuthenticationPolicy
 from pyramid.authorization import ACLAuthorizationPolicy
 from pyramid.config import Configurator
+from pyramid.events import NewRequest
 from pyramid.security import ALL_PERMISSIONS, Allow, Authenticated
 from pyramid.session import UnencryptedCookieSessionFactoryConfig
+from pyramid.settings import asbool
 from sqlalchemy import engine_from_config
 from .helpers import get_queue_func
-from .models import configure_sql, create_schema, populate_database
+from .models import Session, configure_sql, create_schema, populate_database
 from .security import get_user, group_finder
 
 __version__ = '1.3.3'
@@ -74,11 +76,19 @@ def add_routes(config):
     config.add_route('user_join', '/form/user/join')
 
 
+def remove_session(event):
+    """Release the request's database session once the request finishes."""
+    event.request.add_finished_callback(lambda request: Session.remove())
+
+
 def main(global_config, **settings):
     """ This function returns a Pyramid WSGI application.
     """
-    # Initialize the database
-    engine = engine_from_config(settings, 'sqlalchemy.')
+    # Initialize the database. engine_from_config passes pool_pre_ping through
+    # as a string, so any value (even "false") would enable it.
+    engine = engine_from_config(
+        settings, 'sqlalchemy.',
+        pool_pre_ping=asbool(settings.get('sqlalchemy.pool_pre_ping')))
     configure_sql(engine)
 
     secure_cookies = settings.get('secure_cookies') != 'false'
@@ -104,6 +114,8 @@ def main(global_config, **settings):
     config.add_request_method(get_user, 'user', reify=True)
     config.add_request_method(get_queue_func, 'queue', reify=True)
 
+    config.add_subscriber(remove_session, NewRequest)
+
     add_routes(config)
     config.scan()
     return config.make_wsgi_app()
@@ -6,6 +6,11 @@ class SubmitException(Exception):
     """Superclass for all Submit exceptions."""
 
 
+class ChecksumMismatch(SubmitException):
+
+    """Indicates that file contents do not match the expected checksum."""
+
+
 class GroupWithException(SubmitException):
 
     """Indicates there are too many users to join a group."""
@@ -5,6 +5,8 @@ import pickle
 import pika
 import re
 import traceback
+from base64 import b64decode
+from functools import total_ordering
 from pyramid_addons.helpers import http_created, http_ok
 from pyramid_addons.validation import (SOURCE_MATCHDICT, EmailAddress,
                                        TextNumber, Validator)
@@ -15,11 +17,44 @@ from pyramid_mailer.message import Message
 from pyramid.response import FileResponse
 from pyramid.settings import asbool
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import subqueryload
 from tempfile import NamedTemporaryFile
-from zipfile import ZipFile
+from zipfile import ZIP_STORED, ZipFile
 from .exceptions import InvalidId
 
+_ALPHANUM_SPLIT = re.compile('([0-9]+)').split
 
+
+class Base64Reader(object):
+
+    """A read-only file-like object over base64 encoded text.
+
+    The text is decoded a chunk at a time so that the decoded bytes never need
+    to be held in memory all at once. Whitespace within the text is ignored.
+
+    """
+
+    def __init__(self, text):
+        self.offset = 0
+        self.pending = ''
+        self.text = text
+
+    def read(self, size):
+        """Return roughly `size` decoded bytes, or b'' when exhausted."""
+        while True:
+            end = self.offset + (size // 3 + 1) * 4
+            chunk = self.pending + ''.join(self.text[self.offset:end].split())
+            self.offset = end
+            if end < len(self.text):
+                usable = len(chunk) - len(chunk) % 4
+            else:
+                usable = len(chunk)
+            self.pending = chunk[usable:]
+            if usable or end >= len(self.text):
+                return b64decode(chunk[:usable])
+
+
+@total_ordering
 class TestableStatus(object):
     def __init__(self, testable, testable_result, verification_errors):
         self.issue = None
@@ -40,8 +75,8 @@ class TestableStatus(object):
             self.issue = ('One or more of the required files did not pass '
                           'verification (see below)')
 
-    def __cmp__(self, other):
-        return cmp(self.testable, other.testable)
+    def __lt__(self, other):
+        return self.testable < other.testable
 
 
 class DummyTemplateAttr(object):
@@ -93,13 +128,19 @@ class UmailAddress(EmailAddress):
 
 class DBThing(Validator):
 
-    """A validator that converts a primary key into the database object."""
+    """A validator that converts a primary key into the database object.
+
+    `options` is an optional sequence of loader options (e.g. `joinedload`)
+    applied to the query that fetches the object by its primary key.
+
+    """
 
     def __init__(self, param, cls, fetch_by=None, validator=None,
-                 **kwargs):
+                 options=None, **kwargs):
         super(DBThing, self).__init__(param, **kwargs)
         self.cls = cls
         self.fetch_by = fetch_by
+        self.options = options
         self.id_validator = validator if validator else TextNumber(param,
                                                                    min_value=0)
 
@@ -108,10 +149,13 @@ class DBThing(Validator):
         value = self.id_validator(value, errors, request)
         if errors:
             return None
-        if self.fetch_by:
+        if self.fetch_by:  # Models may convert the value (e.g. PasswordReset)
             thing = self.cls.fetch_by(**{self.fetch_by: value})
-        else:
-            thing = self.cls.fetch_by_id(value)
+        else:  # Primary key lookups consult the identity map first
+            query = Session.query(self.cls)
+            if self.options:
+                query = query.options(*self.options)
+            thing = query.get(value)
         if not thing and self.source == SOURCE_MATCHDICT:
             # If part of the URL we should have a not-found error
             raise HTTPNotFound()
@@ -220,8 +264,17 @@ def alphanum_key(string):
     Adapted from: http://stackoverflow.com/a/2669120/176978
 
     """
-    convert = lambda text: int(text) if text.isdigit() else text
-    return [convert(segment) for segment in re.split('([0-9]+)', string)]
+    return [int(segment) if segment.isdigit() else segment
+            for segment in _ALPHANUM_SPLIT(string)]
+
+
+def alphanum_sort(items, attr):
+    """Return `items` sorted by the alphanum_key of their `attr` attribute.
+
+    Each key is computed once per item rather than once per comparison.
+
+    """
+    return sorted(items, key=lambda item: alphanum_key(getattr(item, attr)))
 
 
 def clone(item, exclude=None, update=None):
@@ -266,7 +319,7 @@ def fetch_request_ids(item_ids, cls, attr_name, verification_list=None):
         return []
     items = []
     for item_id in item_ids:
-        item = cls.fetch_by_id(item_id)
+        item = Session.query(cls).get(item_id)
         if not item or (verification_list is not None and
                         item not in verification_list):
             raise InvalidId(attr_name)
@@ -355,8 +408,11 @@ def prev_next_group(project, group):
     project's groups with respect to the passed in group.
 
     """
-    # TODO: Profile and optimize this query if necessary
-    groups = sorted(x for x in project.groups if x.submissions)
+    groups = sorted(Group.query_by(project=project)
+                    .filter(Group.submissions.any())
+                    .options(subqueryload(Group.group_assocs),
+                             subqueryload(Group.group_assocs,
+                                          UserToGroup.user)).all())
     try:
         index = groups.index(group)
     except ValueError:
@@ -481,7 +537,7 @@ def zip_response(request, filename, files):
     """
     tmp_file = NamedTemporaryFile()
     try:
-        with ZipFile(tmp_file, 'w') as zip_file:
+        with ZipFile(tmp_file, 'w', ZIP_STORED, allowZip64=True) as zip_file:
             for zip_path, actual_path in files:
                 zip_file.write(actual_path, zip_path)
         tmp_file.flush()  # Just in case
@@ -507,7 +563,7 @@ def zip_response_adv(request, filename, files):
     """
     tmp_file = NamedTemporaryFile()
     try:
-        with ZipFile(tmp_file, 'w') as zip_file:
+        with ZipFile(tmp_file, 'w', ZIP_STORED, allowZip64=True) as zip_file:
             for type, zip_path, actual in files:
                 if type == "file":
                     zip_file.write(actual, zip_path)
@@ -524,5 +580,5 @@ def zip_response_adv(request, filename, files):
 
 # Avoid cyclic import
 from .diff_unit import DiffWithMetadata, ImageOutput, TextOutput
-from .models import (BuildFile, File, FileVerifier, PasswordReset, Session,
-                     Submission, User)
+from .models import (BuildFile, File, FileVerifier, Group, PasswordReset,
+                     Session, Submission, User, UserToGroup)
@@ -0,0 +1,131 @@
+"""Store verification results as JSON rather than a pickle.
+
+Revision ID: 1f3b5d8a9c2e
+Revises: 4ae1e9a2ff2
+Create Date: 2026-10-15 09:12:41.318204
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1f3b5d8a9c2e'
+down_revision = '4ae1e9a2ff2'
+
+from alembic import op
+from io import BytesIO
+import json
+import pickle
+import sqlalchemy as sa
+
+submission = sa.sql.table('submission',
+                          sa.Column('id', sa.Integer),
+                          sa.Column('verification_results', sa.LargeBinary),
+                          sa.Column('verification_results_new',
+                                    sa.UnicodeText))
+
+submission_downgrade = sa.sql.table(
+    'submission',
+    sa.Column('id', sa.Integer),
+    sa.Column('verification_results', sa.UnicodeText),
+    sa.Column('verification_results_new', sa.LargeBinary))
+
+# The names the pickled class was stored under (the project was once called
+# nudibranch)
+PICKLED_NAMES = set([('nudibranch.models', 'VerificationResults'),
+                     ('submit.models', 'VerificationResults')])
+
+
+class VerificationResults(object):
+    """Stand-in for the pickled class so that this migration does not depend
+    on the current models."""
+
+
+class ResultsUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        if (module, name) in PICKLED_NAMES:
+            return VerificationResults
+        return pickle.Unpickler.find_class(self, module, name)
+
+
+class ResultsPickler(pickle.Pickler):
+    def save(self, obj):
+        if obj is VerificationResults:  # Refer to the class as models did
+            self.write(pickle.GLOBAL + b'submit.models\nVerificationResults\n')
+            self.memoize(obj)
+        else:
+            pickle.Pickler.save(self, obj)
+
+
+def dumps(results):
+    fp = BytesIO()
+    ResultsPickler(fp, pickle.HIGHEST_PROTOCOL).dump(results)
+    return fp.getvalue()
+
+
+def loads(data):
+    return ResultsUnpickler(BytesIO(data)).load()
+
+
+def from_json(data):
+    results = VerificationResults()
+    results._errors_by_filename = data['errors']
+    results._extra_filenames = None
+    if data['extra_filenames'] is not None:
+        results._extra_filenames = frozenset(data['extra_filenames'])
+    results._missing_to_testable_ids = {
+        frozenset(filenames): set(ids)
+        for filenames, ids in data['missing_to_testable_ids']}
+    results._warnings_by_filename = data['warnings']
+    return results
+
+
+def to_json(results):
+    extra = results._extra_filenames
+    warnings = {filename: [dict(x, token=to_text(x['token'])) for x in items]
+                for filename, items in results._warnings_by_filename.items()}
+    return {'errors': results._errors_by_filename,
+            'extra_filenames': None if extra is None else sorted(extra),
+            'missing_to_testable_ids': [
+                [sorted(filenames), sorted(ids)] for filenames, ids
+                in results._missing_to_testable_ids.items()],
+            'warnings': warnings}
+
+
+def to_text(token):
+    """Decode a warning token, which was matched against the raw bytes of a
+    submitted file (a tuple when the regex has groups)."""
+    if isinstance(token, bytes):
+        return token.decode('utf-8', 'replace')
+    if isinstance(token, tuple):
+        return tuple(to_text(x) for x in token)
+    return token
+
+
+def upgrade():
+    op.add_column('submission', sa.Column('verification_results_new',
+                                          sa.UnicodeText(), nullable=True))
+    conn = op.get_bind()
+    for (s_id, results, _) in conn.execute(
+            submission.select()
+            .where(submission.c.verification_results != None)):
+        op.execute(submission.update().where(submission.c.id == s_id)
+                   .values(verification_results_new=json.dumps(
+                       to_json(loads(results)))))
+    op.drop_column('submission', 'verification_results')
+    op.alter_column('submission', 'verification_results_new',
+                    new_column_name='verification_results')
+
+
+def downgrade():
+    op.add_column('submission', sa.Column('verification_results_new',
+                                          sa.PickleType(), nullable=True))
+    conn = op.get_bind()
+    for (s_id, results, _) in conn.execute(
+            submission_downgrade.select()
+            .where(submission_downgrade.c.verification_results != None)):
+        op.execute(submission_downgrade.update()
+                   .where(submission_downgrade.c.id == s_id)
+                   .values(verification_results_new=dumps(
+                       from_json(json.loads(results)))))
+    op.drop_column('submission', 'verification_results')
+    op.alter_column('submission', 'verification_results_new',
+                    new_column_name='verification_results')
@@ -0,0 +1,27 @@
+"""Add indexes for submission lookups.
+
+Revision ID: 5c2e7a4f1b93
+Revises: 1f3b5d8a9c2e
+Create Date: 2026-10-15 10:03:27.554817
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5c2e7a4f1b93'
+down_revision = '1f3b5d8a9c2e'
+
+from alembic import op
+
+
+def upgrade():
+    op.create_index('ix_submission_project_group_created', 'submission',
+                    ['project_id', 'group_id', 'created_at'], unique=False)
+    op.create_index('ix_submissiontofile_submission_id', 'submissiontofile',
+                    ['submission_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_submissiontofile_submission_id',
+                  table_name='submissiontofile')
+    op.drop_index('ix_submission_project_group_created',
+                  table_name='submission')
@@ -7,19 +7,24 @@ import sys
 import transaction
 import uuid
 from datetime import datetime, timedelta
+from functools import total_ordering
 from hashlib import sha1
 from pyramid_addons.helpers import UTC
 from sqla_mixins import BasicBase, UserMixin
 from sqlalchemy import (Binary, Boolean, Column, DateTime, Enum, ForeignKey,
-                        Integer, PickleType, String, Table, Unicode,
-                        UnicodeText, and_, func)
+                        Index, Integer, String, Table, Unicode, UnicodeText,
+                        and_, bindparam, exists, func, not_, or_)
 from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.ext import baked
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import backref, relationship, scoped_session, sessionmaker
+from sqlalchemy.orm import (backref, joinedload, relationship, scoped_session,
+                            sessionmaker, subqueryload)
 from sqlalchemy.schema import UniqueConstraint
+from sqlalchemy.types import TypeDecorator
+from tempfile import NamedTemporaryFile
 from zope.sqlalchemy import ZopeTransactionExtension
-from .exceptions import GroupWithException
-from .helpers import alphanum_key
+from .exceptions import ChecksumMismatch, GroupWithException
+from .helpers import alphanum_key, alphanum_sort
 
 if sys.version_info < (3, 0):
     builtins = __import__('__builtin__')
@@ -30,6 +35,13 @@ Base = declarative_base()
 Session = scoped_session(sessionmaker(extension=ZopeTransactionExtension()))
 # Make Session available to sqla_mixins
 builtins._sqla_mixins_session = Session
+# Cache of compiled SQL for frequently issued lookups
+bakery = baked.bakery()
+# The mode open() gives new files. It is read once at import because reading
+# the umask means briefly changing it.
+umask = os.umask(0)
+os.umask(umask)
+file_mode = 0o666 & ~umask
 
 
 testable_to_build_file = Table(
@@ -69,6 +81,7 @@ user_to_file = Table(
     Column('file_id', Integer, ForeignKey('file.id'), primary_key=True))
 
 
+@total_ordering
 class BuildFile(BasicBase, Base):
     __table_args__ = (UniqueConstraint('filename', 'project_id'),)
     file = relationship('File', backref='build_files')
@@ -76,8 +89,8 @@ class BuildFile(BasicBase, Base):
     filename = Column(Unicode, nullable=False)
     project_id = Column(Integer, ForeignKey('project.id'), nullable=False)
 
-    def __cmp__(self, other):
-        return cmp(alphanum_key(self.filename), alphanum_key(other.filename))
+    def __lt__(self, other):
+        return alphanum_key(self.filename) < alphanum_key(other.filename)
 
     def can_edit(self, user):
         """Return whether or not the user can edit the build file."""
@@ -89,6 +102,7 @@ class BuildFile(BasicBase, Base):
         return json.dumps(data) if jsonify else data
 
 
+@total_ordering
 class Class(BasicBase, Base):
     is_locked = Column(Boolean, default=False, nullable=False,
                        server_default='0')
@@ -102,25 +116,29 @@ class Class(BasicBase, Base):
     def __str__(self):
         return 'Class Name: {0}'.format(self.name)
 
-    def __cmp__(self, other):
-        locked = cmp(self.is_locked, other.is_locked)
-        if locked:
-            return locked
-        return cmp(alphanum_key(self.name), alphanum_key(other.name))
+    @property
+    def sort_key(self):
+        """Order unlocked classes first, then by name."""
+        return self.is_locked, alphanum_key(self.name)
+
+    def __lt__(self, other):
+        return self.sort_key < other.sort_key
 
     def can_edit(self, user):
         """Return whether or not `user` can make changes to the class."""
-        return user.is_admin or not self.is_locked and self in user.admin_for
+        return user.is_admin or not self.is_locked \
+            and self.id in user.admin_for_ids
 
     def can_view(self, user):
         """Return whether or not `user` can view the class."""
-        return self.is_admin(user) or self in user.classes
+        return self.is_admin(user) or self.id in user.class_ids
 
     def is_admin(self, user):
         """Return whether or not `user` is an admin for the class."""
-        return user.is_admin or self in user.admin_for
+        return user.is_admin or self.id in user.admin_for_ids
 
 
+@total_ordering
 class ExecutionFile(BasicBase, Base):
     __table_args__ = (UniqueConstraint('filename', 'project_id'),)
     file = relationship('File', backref='execution_files')
@@ -128,8 +146,8 @@ class ExecutionFile(BasicBase, Base):
     filename = Column(Unicode, nullable=False)
     project_id = Column(Integer, ForeignKey('project.id'), nullable=False)
 
-    def __cmp__(self, other):
-        return cmp(alphanum_key(self.filename), alphanum_key(other.filename))
+    def __lt__(self, other):
+        return alphanum_key(self.filename) < alphanum_key(other.filename)
 
     def can_edit(self, user):
         """Return whether or not the user can edit the build file."""
@@ -142,80 +160,138 @@ class ExecutionFile(BasicBase, Base):
 
 
 class File(BasicBase, Base):
+    CHUNK_SIZE = 65536
+    HASH_CTOR = sha1  # Must match the digest clients compute on upload
     lines = Column(Integer, nullable=False)
     sha1 = Column(String, nullable=False, unique=True)
     size = Column(Integer, nullable=False)
 
+    @staticmethod
+    def fetch_by_sha1(sha1sum):
+        """Return the File with the given sha1sum, or None."""
+        query = bakery(lambda session: session.query(File))
+        query += lambda q: q.filter(File.sha1 == bindparam('sha1'))
+        return query(Session()).params(sha1=sha1sum).first()
+
     @staticmethod
     def fetch_or_create(data, base_path, sha1sum=None):
+        """Return the File containing `data`, saving it if it is new.
+
+        `data` may either be a byte string, or a readable file-like object. A
+        file-like object is hashed and written to disk in a single streaming
+        pass so that its contents never need to be held in memory. In that
+        case a provided `sha1sum` is verified, raising ChecksumMismatch with
+        the actual digest when it differs.
+
+        """
+        if hasattr(data, 'read'):
+            return File._fetch_or_create_from_stream(data, base_path, sha1sum)
         if not sha1sum:
-            sha1sum = sha1(data).hexdigest()
-        file_ = File.fetch_by(sha1=sha1sum)
+            sha1sum = File.HASH_CTOR(data).hexdigest()
+        file_ = File.fetch_by_sha1(sha1sum)
         if not file_:
             file_ = File(base_path=base_path, data=data, sha1=sha1sum)
             Session.add(file_)
             Session.flush()
         return file_
 
+    @staticmethod
+    def _fetch_or_create_from_stream(source, base_path, expected=None):
+        File._make_dirs(base_path)
+        hasher = File.HASH_CTOR()
+        lines = size = 0
+        tmp = NamedTemporaryFile(dir=base_path, delete=False)
+        try:
+            with tmp:
+                while True:
+                    chunk = source.read(File.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    hasher.update(chunk)
+                    tmp.write(chunk)
+                    lines += chunk.count(b'\n')
+                    size += len(chunk)
+            sha1sum = hasher.hexdigest()
+            if expected and expected != sha1sum:
+                raise ChecksumMismatch(sha1sum)
+            file_ = File.fetch_by_sha1(sha1sum)
+            if not file_:
+                file_ = File(base_path=base_path, data=None, sha1=sha1sum,
+                             lines=lines, size=size)
+                # NamedTemporaryFile creates the file readable only by us
+                os.chmod(tmp.name, file_mode)
+                os.rename(tmp.name, File.file_path(base_path, sha1sum))
+                Session.add(file_)
+                Session.flush()
+        finally:
+            if os.path.exists(tmp.name):
+                os.unlink(tmp.name)
+        return file_
+
+    @staticmethod
+    def _make_dirs(path):
+        try:
+            os.makedirs(path)
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+
     @staticmethod
     def file_path(base_path, sha1sum):
         first = sha1sum[:2]
         second = sha1sum[2:4]
         return os.path.join(base_path, first, second, sha1sum[4:])
 
-    def __init__(self, base_path, data, sha1):
-        self.lines = 0
-        for byte in data:
-            if byte == '\n':
-                self.lines += 1
-        self.size = len(data)
+    def __init__(self, base_path, data, sha1, lines=None, size=None):
+        """Create the File and save `data` to disk.
+
+        When `data` is None the caller is responsible for moving the file's
+        contents into place, and must provide both `lines` and `size`.
+
+        """
+        if lines is None:
+            if isinstance(data, bytes):
+                lines = data.count(b'\n')
+            else:
+                lines = data.count('\n')
+        self.lines = lines
+        self.size = len(data) if size is None else size
         self.sha1 = sha1
         # save file
         path = File.file_path(base_path, sha1)
-        try:
-            os.makedirs(os.path.dirname(path))
-        except OSError as error:
-            if error.errno != errno.EEXIST:
-                raise
-        with open(path, 'wb') as fp:
-            fp.write(data)
+        File._make_dirs(os.path.dirname(path))
+        if data is not None:
+            with open(path, 'wb') as fp:
+                fp.write(data)
 
     def can_view(self, user):
         """Return true if the user can view the file."""
         # Perform simplest checks first
-        if user.is_admin or self in user.files:
+        if user.is_admin or user.owns_file(self):
             return True
-        elif user.admin_for:  # Begin more expensive comparisions
-            # Single-indirect lookup
-            classes = set(x.class_ for x in self.makefile_for_projects)
-            if classes.intersection(user.admin_for):
-                return True
-            # Double indirect lookups
-            classes = set(x.project.class_ for x in self.build_files)
-            if classes.intersection(user.admin_for):
-                return True
-            classes = set(x.project.class_ for x in self.execution_files)
-            if classes.intersection(user.admin_for):
-                return True
-            # Triple-indirect lookups
-            classes = set(x.testable.project.class_ for x in self.expected_for)
-            if classes.intersection(user.admin_for):
-                return True
-            classes = set(x.testable.project.class_ for x in self.stdin_for)
-            if classes.intersection(user.admin_for):
-                return True
-            classes = set(x.submission.project.class_ for x in
-                          self.submission_assocs)
-            if classes.intersection(user.admin_for):
-                return True
-            # 4x-indirect lookups
-            classes = set(x.test_case.testable.project.class_ for x
-                          in self.test_case_result_for)
-            if classes.intersection(user.admin_for):
-                return True
+        class_ids = user.admin_for_ids
+        if class_ids:  # Check every indirection in a single query
+            base = (Session.query(Project.class_id)
+                    .filter(Project.class_id.in_(class_ids)))
+            queries = [
+                base.filter(Project.makefile_id == self.id),
+                base.join(Project.build_files)
+                .filter(BuildFile.file_id == self.id),
+                base.join(Project.execution_files)
+                .filter(ExecutionFile.file_id == self.id),
+                base.join(Project.testables, Testable.test_cases)
+                .filter(or_(TestCase.expected_id == self.id,
+                            TestCase.stdin_id == self.id)),
+                base.join(Project.submissions, Submission.files)
+                .filter(SubmissionToFile.file_id == self.id),
+                base.join(Project.testables, Testable.test_cases,
+                          TestCase.test_case_for)
+                .filter(TestCaseResult.diff_id == self.id)]
+            return queries[0].union_all(*queries[1:]).first() is not None
         return False
 
 
+@total_ordering
 class FileVerifier(BasicBase, Base):
     __table_args__ = (UniqueConstraint('filename', 'project_id'),)
     copy_to_execution = Column(Boolean, server_default='0', default=False,
@@ -229,8 +305,17 @@ class FileVerifier(BasicBase, Base):
     project_id = Column(Integer, ForeignKey('project.id'), nullable=False)
     warning_regex = Column(Unicode)
 
-    def __cmp__(self, other):
-        return cmp(alphanum_key(self.filename), alphanum_key(other.filename))
+    @property
+    def compiled_warning_regex(self):
+        """Return the compiled warning_regex, cached on the instance."""
+        regex = getattr(self, '_compiled_warning_regex', None)
+        if regex is None or regex.pattern != self.warning_regex:
+            regex = re.compile(self.warning_regex)
+            self._compiled_warning_regex = regex
+        return regex
+
+    def __lt__(self, other):
+        return alphanum_key(self.filename) < alphanum_key(other.filename)
 
     def can_edit(self, user):
         return self.project.can_edit(user)
@@ -248,6 +333,7 @@ class FileVerifier(BasicBase, Base):
         return json.dumps(data) if jsonify else data
 
     def verify(self, base_path, file_):
+        """Return the errors and warnings (or None) for `file_`."""
         errors = []
         if file_.size < self.min_size:
             errors.append('must be >= {0} bytes'.format(self.min_size))
@@ -261,11 +347,15 @@ class FileVerifier(BasicBase, Base):
         if not self.warning_regex:
             return errors, None
 
-        regex = re.compile(self.warning_regex)
+        regex = self.compiled_warning_regex
         warnings = []
-        for i, line in enumerate(open(File.file_path(base_path, file_.sha1))):
-            for match in regex.findall(line):
-                warnings.append({'lineno': i + 1, 'token': match})
+        with open(File.file_path(base_path, file_.sha1), 'rb') as fp:
+            for i, line in enumerate(fp):
+                # Submissions need not be UTF-8, while the tokens must be
+                # text to be stored as JSON
+                line = line.decode('utf-8', 'replace')
+                for match in regex.findall(line):
+                    warnings.append({'lineno': i + 1, 'token': match})
         return errors, warnings
 
 
@@ -280,7 +370,7 @@ class Group(BasicBase, Base):
 
     @property
     def users(self):
-        return (x.user for x in self.group_assocs)
+        return [x.user for x in self.group_assocs]
 
     @property
     def users_str(self):
@@ -288,12 +378,12 @@ class Group(BasicBase, Base):
 
     def __lt__(self, other):
         """Compare the first users in sorted order."""
-        return sorted(self.users)[0] < sorted(other.users)[0]
+        return min(self.users) < min(other.users)
 
     def can_view(self, user):
         """Return whether or not `user` can view info about the group."""
         return user.is_admin or user in self.users \
-            or self.project.class_ in user.admin_for
+            or self.project.class_id in user.admin_for_ids
 
 
 class GroupRequest(BasicBase, Base):
@@ -318,8 +408,8 @@ class VerificationResults(object):
 
     """Stores verification information about a single submission.
 
-    WARNING: The attributes of this class cannot easily be changed as this
-    class is pickled in the database.
+    Instances are stored in the database as JSON via `to_json` and
+    `from_json`. Any added attributes must be handled by both methods.
 
     """
 
@@ -345,12 +435,35 @@ class VerificationResults(object):
         import pprint
         return pprint.pformat(vars(self))
 
+    @classmethod
+    def from_json(cls, data):
+        """Return a VerificationResults built from `to_json` output."""
+        retval = cls()
+        retval._errors_by_filename = data['errors']
+        if data['extra_filenames'] is not None:
+            retval._extra_filenames = frozenset(data['extra_filenames'])
+        retval._missing_to_testable_ids = {
+            frozenset(filenames): set(ids)
+            for filenames, ids in data['missing_to_testable_ids']}
+        retval._warnings_by_filename = data['warnings']
+        return retval
+
+    def to_json(self):
+        """Return a JSON-serializable representation of these results."""
+        extra = self._extra_filenames
+        return {'errors': self._errors_by_filename,
+                'extra_filenames': None if extra is None else sorted(extra),
+                'missing_to_testable_ids': [
+                    [sorted(filenames), sorted(ids)] for filenames, ids
+                    in self._missing_to_testable_ids.items()],
+                'warnings': self._warnings_by_filename}
+
     def missing_testables(self):
         """Return a set of testables that have files missing."""
-        ids = set()
-        for id_set in self._missing_to_testable_ids.values():
-            ids |= id_set
-        return set(x for x in (Testable.fetch_by_id(y) for y in ids) if x)
+        ids = set().union(*self._missing_to_testable_ids.values())
+        if not ids:
+            return set()
+        return set(Session.query(Testable).filter(Testable.id.in_(ids)))
 
     def set_errors_for_filename(self, errors, filename):
         self._errors_by_filename[filename] = errors
@@ -362,6 +475,23 @@ class VerificationResults(object):
         self._warnings_by_filename[filename] = warnings
 
 
+class VerificationResultsType(TypeDecorator):
+
+    """Store a VerificationResults object as a JSON document."""
+
+    impl = UnicodeText
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return json.dumps(value.to_json())
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return VerificationResults.from_json(json.loads(value))
+
+
 class PasswordReset(Base):
     __tablename__ = 'passwordreset'
     created_at = Column(DateTime(timezone=True), default=func.now(),
@@ -391,6 +521,7 @@ class PasswordReset(Base):
         return str(uuid.UUID(bytes=self.reset_token))
 
 
+@total_ordering
 class Project(BasicBase, Base):
     __table_args__ = (UniqueConstraint('name', 'class_id'),)
     build_files = relationship(BuildFile, backref='project',
@@ -427,8 +558,8 @@ class Project(BasicBase, Base):
         admins = set(self.class_.admins)
         return [x for x in self.submissions if not set(x.group.users) & admins]
 
-    def __cmp__(self, other):
-        return cmp(alphanum_key(self.name), alphanum_key(other.name))
+    def __lt__(self, other):
+        return alphanum_key(self.name) < alphanum_key(other.name)
 
     def build_files_json(self):
         return json.dumps([x.edit_json(False) for x in self.build_files])
@@ -440,7 +571,7 @@ class Project(BasicBase, Base):
 
         """
         return self.class_.is_admin(user) or \
-            self.is_ready and self.class_ in user.classes
+            self.is_ready and self.class_id in user.class_ids
 
     def can_edit(self, user):
         """Return whether or not `user` can make changes to the project."""
@@ -458,9 +589,13 @@ class Project(BasicBase, Base):
 
     def points_possible(self, include_hidden=False):
         """Return the total points possible for this project."""
-        return sum([test_case.points for testable in self.testables
-                    for test_case in testable.test_cases
-                    if include_hidden or not testable.is_hidden])
+        query = (Session.query(func.coalesce(func.sum(TestCase.points), 0))
+                 .select_from(TestCase)
+                 .join(Testable, TestCase.testable_id == Testable.id)
+                 .filter(Testable.project_id == self.id))
+        if not include_hidden:
+            query = query.filter(not_(Testable.is_hidden))
+        return query.scalar()
 
     def process_submissions(self):
         by_group = {}
@@ -486,15 +621,29 @@ class Project(BasicBase, Base):
         return by_group, best_ontime, best
 
     def recent_submissions(self):
-        """Generate a list of the most recent submissions for each user.
+        """Return a list of the most recent submissions for each group.
 
-        Only yields a submission for a user if they've made one.
+        Only includes a submission for a group if they've made one. Should a
+        group have several submissions sharing the latest time, the one with
+        the highest id is used.
 
         """
-        for group in self.groups:
-            submission = Submission.most_recent_submission(self, group)
-            if submission:
-                yield submission
+        latest = (Session.query(Submission.group_id,
+                                func.max(Submission.created_at)
+                                .label('created_at'))
+                  .filter(Submission.project_id == self.id)
+                  .group_by(Submission.group_id).subquery())
+        ids = (Session.query(func.max(Submission.id))
+               .join(latest,
+                     and_(Submission.group_id == latest.c.group_id,
+                          Submission.created_at == latest.c.created_at))
+               .filter(Submission.project_id == self.id)
+               .group_by(Submission.group_id))
+        return (Submission.query_by(project_id=self.id)
+                .filter(Submission.id.in_(ids))
+                .options(joinedload(Submission.group)
+                         .joinedload(Group.group_assocs)
+                         .joinedload(UserToGroup.user)).all())
 
     def submit_string(self):
         """Return a string specifying the files to submit for this project."""
@@ -508,7 +657,8 @@ class Project(BasicBase, Base):
         return ' '.join(sorted(required) + sorted(optional))
 
     def testables_json(self):
-        return json.dumps([x.edit_json(False) for x in sorted(self.testables)]
+        return json.dumps([x.edit_json(False) for x
+                           in alphanum_sort(self.testables, 'name')]
                           + [{'id': 'new', 'name': 'Add New', 'target': '',
                               'executable': '', 'hidden': False,
                               'test_cases': []}])
@@ -519,9 +669,18 @@ class Project(BasicBase, Base):
         valid_files = set()
         file_mapping = submission.file_mapping()
 
-        # Create a list of in-use file verifiers
-        file_verifiers = set(fv for testable in self.testables
-                             for fv in testable.file_verifiers)
+        # Load the testables with their file verifiers in a single pass, and
+        # index both the in-use file verifiers and each testable's required
+        # filenames
+        testables = (Testable.query_by(project_id=self.id)
+                     .options(subqueryload(Testable.file_verifiers)).all())
+        file_verifiers = set()
+        required = {}
+        for testable in testables:
+            file_verifiers.update(testable.file_verifiers)
+            required[testable] = frozenset(x.filename for x
+                                           in testable.file_verifiers
+                                           if not x.optional)
 
         for fv in file_verifiers:
             if fv.filename in file_mapping:
@@ -541,9 +700,8 @@ class Project(BasicBase, Base):
 
         # Determine valid testables
         retval = []
-        for testable in self.testables:
-            missing = frozenset(x.filename for x in testable.file_verifiers
-                                if not x.optional) - valid_files
+        for testable in testables:
+            missing = required[testable] - valid_files
             if missing:
                 results._missing_to_testable_ids.setdefault(
                     missing, set()).add(testable.id)
@@ -560,7 +718,10 @@ class Project(BasicBase, Base):
         return retval
 
 
+@total_ordering
 class Submission(BasicBase, Base):
+    __table_args__ = (Index('ix_submission_project_group_created',
+                            'project_id', 'group_id', 'created_at'),)
     created_by = relationship('User')
     created_by_id = Column(Integer, ForeignKey('user.id'), nullable=False)
     group = relationship(Group, backref='submissions')
@@ -572,7 +733,7 @@ class Submission(BasicBase, Base):
                                      cascade='all, delete-orphan')
     testable_results = relationship('TestableResult', backref='submission',
                                     cascade='all, delete-orphan')
-    verification_results = Column(PickleType)
+    verification_results = Column(VerificationResultsType)
     verified_at = Column(DateTime(timezone=True), index=True)
 
     @property
@@ -609,14 +770,8 @@ class Submission(BasicBase, Base):
                 retval[key] = d2[key]
         return retval
 
-    @staticmethod
-    def most_recent_submission(project, group):
-        """Return the most recent submission for the user and project id."""
-        return (Submission.query_by(project=project, group=group)
-                .order_by(Submission.created_at.desc()).first())
-
-    def __cmp__(self, other):
-        return cmp(self.created_at, other.created_at)
+    def __lt__(self, other):
+        return self.created_at < other.created_at
 
     def can_edit(self, user):
         """Return whether or not `user` can edit the submission."""
@@ -628,7 +783,10 @@ class Submission(BasicBase, Base):
 
     def file_mapping(self):
         """Return a mapping of filename to File object for the submission."""
-        return {x.filename: x.file for x in self.files}
+        return dict(Session.query(SubmissionToFile.filename, File)
+                    .select_from(SubmissionToFile)
+                    .join(File, SubmissionToFile.file_id == File.id)
+                    .filter(SubmissionToFile.submission_id == self.id).all())
 
     def get_delay(self, update):
         """Return the minutes to delay the viewing of submission results.
@@ -725,18 +883,20 @@ class Submission(BasicBase, Base):
         return self.project.verify_submission(base_path, self, update=update)
 
 
+@total_ordering
 class SubmissionToFile(Base):
     __tablename__ = 'submissiontofile'
     file = relationship(File, backref='submission_assocs')
     file_id = Column(Integer, ForeignKey('file.id'), nullable=False)
     filename = Column(Unicode, nullable=False, primary_key=True)
-    submission_id = Column(Integer, ForeignKey('submission.id'),
+    submission_id = Column(Integer, ForeignKey('submission.id'), index=True,
                            primary_key=True, nullable=False)
 
-    def __cmp__(self, other):
-        return cmp(alphanum_key(self.filename), alphanum_key(other.filename))
+    def __lt__(self, other):
+        return alphanum_key(self.filename) < alphanum_key(other.filename)
 
 
+@total_ordering
 class TestCase(BasicBase, Base):
     __table_args__ = (UniqueConstraint('name', 'testable_id'),)
     args = Column(Unicode, nullable=False)
@@ -759,8 +919,8 @@ class TestCase(BasicBase, Base):
     test_case_for = relationship('TestCaseResult', backref='test_case',
                                  cascade='all, delete-orphan')
 
-    def __cmp__(self, other):
-        return cmp(alphanum_key(self.name), alphanum_key(other.name))
+    def __lt__(self, other):
+        return alphanum_key(self.name) < alphanum_key(other.name)
 
     def can_edit(self, user):
         """Return whether or not `user` can make changes to the test_case."""
@@ -816,6 +976,7 @@ class TestCaseResult(Base):
         self.created_at = func.now()
 
 
+@total_ordering
 class Testable(BasicBase, Base):
     """Represents a set of properties for a single program to test."""
     __table_args__ = (UniqueConstraint('name', 'project_id'),)
@@ -838,8 +999,8 @@ class Testable(BasicBase, Base):
     testable_results = relationship('TestableResult', backref='testable',
                                     cascade='all, delete-orphan')
 
-    def __cmp__(self, other):
-        return cmp(alphanum_key(self.name), alphanum_key(other.name))
+    def __lt__(self, other):
+        return alphanum_key(self.name) < alphanum_key(other.name)
 
     def can_edit(self, user):
         """Return whether or not `user` can make changes to the testable."""
@@ -847,14 +1008,14 @@ class Testable(BasicBase, Base):
 
     def edit_json(self, jsonify=True):
         def ids(item):
-            return [x.id for x in sorted(item)]
+            return [x.id for x in alphanum_sort(item, 'filename')]
         data = {'id': self.id, 'name': self.name, 'target': self.make_target,
                 'executable': self.executable, 'hidden': self.is_hidden,
                 'build_files': ids(self.build_files),
                 'execution_files': ids(self.execution_files),
                 'expected_files': ids(self.file_verifiers),
                 'test_cases': [x.edit_json(False) for x in
-                               sorted(self.test_cases)]}
+                               alphanum_sort(self.test_cases, 'name')]}
         return json.dumps(data) if jsonify else data
 
     def points(self):
@@ -902,6 +1063,7 @@ class TestableResult(BasicBase, Base):
         return tr
 
 
+@total_ordering
 class User(UserMixin, BasicBase, Base):
     """The UserMixin provides the `username` and `password` attributes.
     `password` is a write-only attribute and can be verified using the
@@ -915,6 +1077,13 @@ class User(UserMixin, BasicBase, Base):
     is_admin = Column(Boolean, default=False, nullable=False)
     name = Column(Unicode, nullable=False)
 
+    @staticmethod
+    def fetch_by_username(username):
+        """Return the User with the given username, or None."""
+        query = bakery(lambda session: session.query(User))
+        query += lambda q: q.filter(User.username == bindparam('username'))
+        return query(Session()).params(username=username).first()
+
     @staticmethod
     def get_value(cls, value):
         '''Takes the class of the item that we want to
@@ -930,15 +1099,25 @@ class User(UserMixin, BasicBase, Base):
         """Return the user if successful, None otherwise"""
         retval = None
         try:
-            user = User.fetch_by(username=username)
+            user = User.fetch_by_username(username)
             if user and (development_mode or user.verify_password(password)):
                 retval = user
         except OperationalError:
             pass
         return retval
 
-    def __cmp__(self, other):
-        return cmp((self.name, self.username), (other.name, other.username))
+    def __lt__(self, other):
+        return (self.name, self.username) < (other.name, other.username)
+
+    @property
+    def admin_for_ids(self):
+        """Return the set of ids of the classes this user can admin."""
+        return frozenset(x.id for x in self.admin_for)
+
+    @property
+    def class_ids(self):
+        """Return the set of ids of the classes this user is in."""
+        return frozenset(x.id for x in self.classes)
 
     def __repr__(self):
         return 'User(username="{0}", name="{1}")'.format(self.username,
@@ -954,20 +1133,25 @@ class User(UserMixin, BasicBase, Base):
             return False
         u2g = self.fetch_group_assoc(project)
         if u2g:
-            return len(list(u2g.group.users)) < project.group_max
+            return u2g.user_count < project.group_max
         return True
 
     def can_view(self, user):
         """Return whether or not `user` can view information about the user."""
         return user.is_admin or self == user \
-            or set(self.classes).intersection(user.admin_for)
+            or not self.class_ids.isdisjoint(user.admin_for_ids)
+
+    def owns_file(self, file_):
+        """Return whether or not `file_` is in the user's files."""
+        return Session.query(exists().where(and_(
+            user_to_file.c.user_id == self.id,
+            user_to_file.c.file_id == file_.id))).scalar()
 
     def classes_can_admin(self):
         """Return all the classes (sorted) that this user can admin."""
-        if self.is_admin:
-            return sorted(Session.query(Class).all())
-        else:
-            return sorted(self.admin_for)
+        classes = Session.query(Class).all() if self.is_admin \
+            else self.admin_for
+        return sorted(classes, key=lambda x: x.sort_key)
 
     def group_with(self, to_user, project, bypass_limit=False):
         """Join the users in a group."""
@@ -1028,6 +1212,8 @@ class User(UserMixin, BasicBase, Base):
 
     def fetch_group_assoc(self, project):
         return (Session.query(UserToGroup)
+                .options(joinedload(UserToGroup.group)
+                         .joinedload(Group.group_assocs))
                 .filter(UserToGroup.user == self)
                 .filter(UserToGroup.project == project)).first()
 
@@ -1066,8 +1252,7 @@ class UserToGroup(Base):
 
     @property
     def user_count(self):
-        return (Session.query(UserToGroup)
-                .filter(UserToGroup.group_id == self.group_id).count())
+        return len(self.group.group_assocs)
 
     def __eq__(self, other):
         if not isinstance(other, UserToGroup):
@@ -1106,19 +1291,13 @@ def populate_database():
                  username='admin', is_admin=True)
     # Class
     class_ = Class(name='CS32')
-    Session.add(class_)
-    Session.flush()
-
     # Project
-    project = Project(name='Project 1', class_id=class_.id)
-    Session.add(project)
-    Session.flush()
-
+    project = Project(name='Project 1', class_=class_)
     # File verification
     fv = FileVerifier(filename='test.c', min_size=3, min_lines=1,
-                      project_id=project.id)
+                      project=project)
 
-    Session.add_all([admin, fv])
+    Session.add_all([admin, class_, project, fv])
     try:
         transaction.commit()
         print('Admin user created')
@@ -0,0 +1,67 @@
+from __future__ import unicode_literals
+import json
+import shutil
+import tempfile
+import transaction
+import unittest
+from pyramid_addons.validation import SOURCE_MATCHDICT, String
+from sqlalchemy import create_engine
+from .helpers import DBThing
+from .models import (Base, File, FileVerifier, PasswordReset, Session, User,
+                     VerificationResults, VerificationResultsType,
+                     configure_sql)
+
+
+class DatabaseTest(unittest.TestCase):
+
+    """Run each test against a fresh in-memory SQLite database."""
+
+    def setUp(self):
+        configure_sql(create_engine('sqlite://'))
+        Base.metadata.create_all()
+
+    def tearDown(self):
+        transaction.abort()
+        Session.remove()
+        Base.metadata.drop_all()
+
+
+class DBThingTest(DatabaseTest):
+    def test_fetch_by_password_reset_token(self):
+        user = User(name='Student', password='password',
+                    username='student@example.com')
+        reset = PasswordReset.generate(user)
+        Session.add(reset)
+        Session.flush()
+        validator = DBThing('token', PasswordReset, fetch_by='reset_token',
+                            validator=String('token', min_length=36,
+                                             max_length=36,
+                                             source=SOURCE_MATCHDICT),
+                            source=SOURCE_MATCHDICT)
+        errors = []
+        self.assertEqual(reset, validator.run(reset.get_token(), errors, None))
+        self.assertEqual([], errors)
+
+
+class FileVerifierTest(unittest.TestCase):
+    def setUp(self):
+        self.base_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.base_path)
+
+    def test_verify_non_utf8_content(self):
+        data = b'int x;\n// TODO: caf\xe9\n'
+        file_ = File(base_path=self.base_path, data=data,
+                     sha1=File.HASH_CTOR(data).hexdigest())
+        verifier = FileVerifier(filename='a.c', min_size=0, min_lines=0,
+                                warning_regex='TODO.*')
+        errors, warnings = verifier.verify(self.base_path, file_)
+        self.assertEqual([], errors)
+        self.assertEqual([{'lineno': 2, 'token': 'TODO: caf\ufffd'}],
+                         warnings)
+        # The warnings must be storable as JSON
+        results = VerificationResults()
+        results.set_warnings_for_filename(warnings, 'a.c')
+        stored = VerificationResultsType().process_bind_param(results, None)
+        self.assertEqual(warnings, json.loads(stored)['warnings']['a.c'])
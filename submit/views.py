@@ -3,8 +3,6 @@ import codecs
 import numpy
 import os
 import transaction
-from base64 import b64decode
-from hashlib import sha1
 import itertools
 from pyramid_addons.helpers import (http_created, http_gone, http_ok)
 from pyramid_addons.validation import (EmailAddress, Enum, List, Or, String,
@@ -21,12 +19,14 @@ from pyramid.view import (forbidden_view_config, notfound_view_config,
                           view_config)
 import re 
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
 import yaml
 from zipfile import ZipFile
 from .diff_render import HTMLDiff
-from .exceptions import GroupWithException, InvalidId, SubmitException
+from .exceptions import (ChecksumMismatch, GroupWithException, InvalidId,
+                         SubmitException)
 from .helpers import (
-    AccessibleDBThing, DBThing as AnyDBThing, DummyTemplateAttr,
+    AccessibleDBThing, Base64Reader, DBThing as AnyDBThing, DummyTemplateAttr,
     EditableDBThing, TestableStatus, TextDate, ViewableDBThing, UmailAddress,
     add_user, clone, fetch_request_ids, file_verifier_verification,
     prepare_renderable, prev_next_submission, prev_next_group,
@@ -35,15 +35,15 @@ from .helpers import (
 from .models import (BuildFile, Class, ExecutionFile, File, FileVerifier,
                      Group, GroupRequest, PasswordReset, Project, Session,
                      Submission, SubmissionToFile, TestCase, Testable, User,
-                     UserToGroup)
+                     UserToGroup, user_to_file)
 
-# Hack for old pickle files
-# TODO: Migrate this data to not use pickle
+# Hack for diff files pickled before the project was renamed. Verification
+# results are stored as JSON now, so diffs are the only remaining pickles.
+# TODO: Migrate the diffs to not use pickle
 import sys
 import submit
 sys.modules['nudibranch'] = submit
 sys.modules['nudibranch.diff_unit'] = submit.diff_unit
-sys.modules['nudibranch.models'] = submit.models
 
 # A few reoccuring validators
 OUTPUT_SOURCE = Enum('output_source', 'stdout', 'stderr', 'file')
@@ -53,6 +53,11 @@ SHA1_VALIDATOR = String('sha1sum', min_length=40, max_length=40,
 UUID_VALIDATOR = String('token', min_length=36, max_length=36,
                         source=MATCHDICT)
 
+# Project permission checks always read the class, so load it with the project.
+# The path is named by string because Project.class_ is a backref that does
+# not exist until the mappers are configured.
+PROJECT_WITH_CLASS = (joinedload('class_'),)
+
 
 # We need a specific view config for each of HTTPError, HTTPOk, and
 # HTTPRedirection as HTTPException will not work as a context. Because python
@@ -213,18 +218,17 @@ def execution_file_delete(request, execution_file):
              permission='authenticated')
 @validate(b64data=WhiteSpaceString('b64data'), sha1sum=SHA1_VALIDATOR)
 def file_create(request, b64data, sha1sum):
-    data = b64decode(b64data.encode('ascii'))
-    # Verify the sha1 matches
-    expected_sha1 = sha1(data).hexdigest()
-    if sha1sum != expected_sha1:
-        msg = 'sha1sum does not match expected: {0}'.format(expected_sha1)
-        raise HTTPBadRequest(msg)
-
-    # fetch or create (and save to disk) the file
+    # fetch or create (and save to disk) the file verifying the sha1 matches
     base_path = request.registry.settings['file_directory']
-    file_ = File.fetch_or_create(data, base_path, sha1sum=sha1sum)
+    try:
+        file_ = File.fetch_or_create(Base64Reader(b64data), base_path,
+                                     sha1sum=sha1sum)
+    except ChecksumMismatch as exc:
+        msg = 'sha1sum does not match expected: {0}'.format(exc.args[0])
+        raise HTTPBadRequest(msg)
     # associate user with the file
-    request.user.files.add(file_)
+    if not request.user.owns_file(file_):
+        request.user.files.add(file_)
     return {'file_id': file_.id}
 
 
@@ -233,7 +237,7 @@ def file_create(request, b64data, sha1sum):
 @validate(file_=ViewableDBThing('sha1sum', File, fetch_by='sha1',
                                 validator=SHA1_VALIDATOR, source=MATCHDICT))
 def file_item_info(request, file_):
-    return {'file_id': file_.id, 'owns_file': file_ in request.user.files}
+    return {'file_id': file_.id, 'owns_file': request.user.owns_file(file_)}
 
 
 @view_config(route_name='file_item', request_method='GET',
@@ -269,7 +273,8 @@ def file_item_view(request, file_, filename, raw):
           max_lines=TextNumber('max_lines', min_value=0, optional=True),
           optional=TextNumber('optional', min_value=0, max_value=1,
                               optional=True),
-          project=EditableDBThing('project_id', Project),
+          project=EditableDBThing('project_id', Project,
+                                  options=PROJECT_WITH_CLASS),
           warning_regex=RegexString('warning_regex', optional=True))
 @file_verifier_verification
 def file_verifier_create(request, copy_to_execution, filename, min_size,
@@ -361,7 +366,7 @@ def home(request):
 def password_reset_create(request, username):
     if username == 'admin':
         raise HTTPConflict('Hahaha, nice try!')
-    user = User.fetch_by(username=username)
+    user = User.fetch_by_username(username)
     if not user:
         raise HTTPConflict('Invalid email')
     password_reset = PasswordReset.generate(user)
@@ -506,7 +511,8 @@ def project_download(request, project):
 @view_config(route_name='project_edit',
              renderer='templates/forms/project_edit.pt',
              request_method='GET', permission='authenticated')
-@validate(project=ViewableDBThing('project_id', Project, source=MATCHDICT))
+@validate(project=ViewableDBThing('project_id', Project, source=MATCHDICT,
+                                  options=PROJECT_WITH_CLASS))
 def project_edit(request, project):
     action = request.route_path('project_item_summary',
                                 class_id=project.class_.id,
@@ -616,7 +622,7 @@ def project_import(request, project):
 
     with ZipFile(import_file,"r") as myzip:
         # upload every file we were given to the backing store... this may not acutally be the best approach
-        submit_files = {path.strip("/") : File.fetch_or_create(myzip.read(path), base_path) for path in myzip.namelist()}
+        submit_files = {path.strip("/") : File.fetch_or_create(myzip.open(path), base_path) for path in myzip.namelist()}
         #return myzip.namelist()
 
         file_list = sorted([path for path,v in submit_files.iteritems()])
@@ -980,8 +986,8 @@ def project_group_request_confirm(request, project, group_request):
 def project_group_request_create(request, project, username):
     if not request.user.can_join_group(project):
         raise HTTPConflict('You cannot expand your group for this project.')
-    user = User.fetch_by(username=username)
-    if not user or project.class_ not in user.classes:
+    user = User.fetch_by_username(username)
+    if not user or project.class_id not in user.class_ids:
         raise HTTPConflict('Invalid email.')
     if not user.can_join_group(project):
         raise HTTPConflict('That user cannot join your group.')
@@ -1160,7 +1166,8 @@ def project_test_case_generate(request, submission):
           deadline=TextDate('deadline', optional=True),
           delay_minutes=TextNumber('delay_minutes', min_value=1),
           group_max=TextNumber('group_max', min_value=1),
-          project=EditableDBThing('project_id', Project, source=MATCHDICT))
+          project=EditableDBThing('project_id', Project, source=MATCHDICT,
+                                  options=PROJECT_WITH_CLASS))
 def project_update(request, name, makefile, is_ready, deadline, delay_minutes,
                    group_max, project):
     # Fix timezone if it doesn't exist
@@ -1184,7 +1191,8 @@ def project_update(request, name, makefile, is_ready, deadline, delay_minutes,
              request_method=('GET', 'HEAD'),
              renderer='templates/project_view_detailed.pt',
              permission='authenticated')
-@validate(project=AccessibleDBThing('project_id', Project, source=MATCHDICT),
+@validate(project=AccessibleDBThing('project_id', Project, source=MATCHDICT,
+                                    options=PROJECT_WITH_CLASS),
           group=ViewableDBThing('group_id', Group, source=MATCHDICT))
 def project_view_detailed(request, project, group):
     submissions = Submission.query_by(project=project, group=group)
@@ -1213,15 +1221,16 @@ def project_view_detailed(request, project, group):
              renderer='templates/project_view_detailed.pt',
              request_method=('GET', 'HEAD'),
              permission='authenticated')
-@validate(project=AccessibleDBThing('project_id', Project, source=MATCHDICT),
+@validate(project=AccessibleDBThing('project_id', Project, source=MATCHDICT,
+                                    options=PROJECT_WITH_CLASS),
           user=ViewableDBThing('username', User, fetch_by='username',
                                validator=String('username'), source=MATCHDICT))
 def project_view_detailed_user(request, project, user):
-    group_assoc = user.fetch_group_assoc(project)
-    if group_assoc:
+    group_id = (Session.query(UserToGroup.group_id)
+                .filter_by(project=project, user=user).scalar())
+    if group_id:
         url = request.route_path('project_item_detailed',
-                                 project_id=project.id,
-                                 group_id=group_assoc.group_id)
+                                 project_id=project.id, group_id=group_id)
         raise HTTPFound(location=url)
     return {'project': project,
             'project_admin': False,
@@ -1236,7 +1245,8 @@ def project_view_detailed_user(request, project, user):
 @view_config(route_name='project_item_summary', request_method=('GET', 'HEAD'),
              renderer='templates/project_view_summary.pt',
              permission='authenticated')
-@validate(project=ViewableDBThing('project_id', Project, source=MATCHDICT))
+@validate(project=ViewableDBThing('project_id', Project, source=MATCHDICT,
+                                  options=PROJECT_WITH_CLASS))
 def project_view_summary(request, project):
     # Compute student stats
     by_group, best_ontime, best = project.process_submissions()
@@ -1343,7 +1353,10 @@ def submission_create(request, project, file_ids, filenames):
 
     # Verify user permission on files
     msgs = []
-    user_files = {x.id: x for x in request.user.files}
+    user_files = {x.id: x for x in Session.query(File)
+                  .join(user_to_file, user_to_file.c.file_id == File.id)
+                  .filter(user_to_file.c.user_id == request.user.id,
+                          File.id.in_(file_ids))}
     files = set()
     for i, file_id in enumerate(file_ids):
         if file_id in user_files:
@@ -1361,15 +1374,14 @@ def submission_create(request, project, file_ids, filenames):
             continue
         user.files.update(files)
 
-    # Associate the files with the submissions by their submission name
-    assoc = []
-    for file_id, filename in zip(file_ids, filenames):
-        assoc.append(SubmissionToFile(file_id=file_id, filename=filename))
-    submission.files.extend(assoc)
     Session.add(submission)
-    Session.add_all(assoc)
     Session.flush()
     submission_id = submission.id
+    # Associate the files with the submissions by their submission name
+    Session.bulk_insert_mappings(SubmissionToFile, [
+        {'file_id': file_id, 'filename': filename,
+         'submission_id': submission_id}
+        for file_id, filename in zip(file_ids, filenames)])
     # We must commit the transaction before queueing the job.
     transaction.commit()
     request.queue(submission_id=submission_id)
@@ -1711,9 +1723,9 @@ def user_create_special(request, name, username, verification):
 def user_join(request):
     # get all the classes that the given user is not in, and let the
     # user optionally join them
-    all_classes = frozenset(Class.query_by(is_locked=False).all())
-    user_classes = frozenset(request.user.classes)
-    return {'classes': sorted(all_classes - user_classes)}
+    classes = (Class.query_by(is_locked=False)
+               .filter(~Class.users.any(User.id == request.user.id)).all())
+    return {'classes': sorted(classes)}
 
 
 @view_config(route_name='user_new', request_method='GET',
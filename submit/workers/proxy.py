@@ -5,14 +5,22 @@ import pickle
 import random
 import subprocess
 import time
+from functools import partial
 from heapq import heappop, heappush
+from pyramid.settings import asbool
 from sqlalchemy import engine_from_config
+from sqlalchemy.orm import subqueryload
 from .exceptions import HandledError, SSHConnectTimeout
 from .. import workers
 from ..diff_unit import Diff
-from ..models import (File, Session, Submission, TestCaseResult, Testable,
+from ..models import (BuildFile, ExecutionFile, File, Session, Submission,
+                      SubmissionToFile, TestCase, TestCaseResult, Testable,
                       TestableResult, configure_sql)
 
+# Kept in ~/.ssh so that other local users cannot predict or hijack the
+# sockets; ssh expands the %-tokens for each connection
+CONTROL_PATH = os.path.join(os.path.expanduser('~'), '.ssh', 'submit_%r@%h:%p')
+
 
 def set_expected_files(testable, results, base_file_path):
     # Update the expected output of each test case
@@ -22,8 +30,8 @@ def set_expected_files(testable, results, base_file_path):
                             .format(test_case.id))
         if test_case.output_type == 'diff':
             output_file = 'tc_{0}'.format(test_case.id)
-            test_case.expected = File.fetch_or_create(
-                open(output_file).read(), base_file_path)
+            with open(output_file, 'rb') as fp:
+                test_case.expected = File.fetch_or_create(fp, base_file_path)
     testable.is_locked = False
     if not any(x.is_locked for x in testable.project.testables):
         testable.project.status = u'notready'
@@ -32,21 +40,23 @@ def set_expected_files(testable, results, base_file_path):
 def compute_diff(test_case, test_case_result, output_file, base_file_path):
     """Associate the diff (if exists) with the TestCaseResult.
 
+    `output_file` is None when the test case produced no output file.
+
     Return whether or not the outputs match.
 
     """
     with open(File.file_path(base_file_path, test_case.expected.sha1)) as fp:
         expected_output = fp.read()
     actual_output = ''
-    if os.path.isfile(output_file):
-        with open('tc_{0}'.format(test_case.id)) as fp:
+    if output_file:
+        with open(output_file) as fp:
             actual_output = fp.read()
+    if expected_output == actual_output:
+        return True
     unit = Diff(expected_output, actual_output)
-    if not unit.outputs_match():
-        test_case_result.diff = File.fetch_or_create(pickle.dumps(unit),
-                                                     base_file_path)
-        return False
-    return True
+    test_case_result.diff = File.fetch_or_create(
+        pickle.dumps(unit, pickle.HIGHEST_PROTOCOL), base_file_path)
+    return False
 
 
 class WorkerProxy():
@@ -63,7 +73,9 @@ class WorkerProxy():
             machines = [machines]
         random.shuffle(machines)
         self.machines = [(5., x) for x in machines]
-        engine = engine_from_config(settings, 'sqlalchemy.')
+        engine = engine_from_config(
+            settings, 'sqlalchemy.',
+            pool_pre_ping=asbool(settings.get('sqlalchemy.pool_pre_ping')))
         configure_sql(engine)
 
         worker = amqp_worker.AMQPWorker(
@@ -85,7 +97,14 @@ class WorkerProxy():
         if not submission:
             raise HandledError('Invalid submission id: {0}'
                                .format(submission_id))
-        testable = Testable.fetch_by_id(testable_id)
+        # Load everything push_files and fetch_results walk up front
+        testable = (Session.query(Testable).options(
+            subqueryload(Testable.execution_files)
+            .joinedload(ExecutionFile.file),
+            subqueryload(Testable.file_verifiers),
+            subqueryload(Testable.test_cases).joinedload(TestCase.expected),
+            subqueryload(Testable.test_cases).joinedload(TestCase.stdin))
+            .filter(Testable.id == testable_id).one_or_none())
         if not testable:
             raise HandledError('Invalid testable id: {0}'.format(testable_id))
         if update_project and submission.project.status != u'locked':
@@ -106,6 +125,11 @@ class WorkerProxy():
             try:
                 # Kill any processes on the worker
                 priority = self.kill_processes(machine)
+                # Share a single connection among the remaining commands
+                if not self.start_master(machine):
+                    workers.log_msg('{}.{} unable to start ssh master ({})'
+                                    .format(submission_id, testable_id,
+                                            machine))
                 # Copy the files to the worker (and remove existing files)
                 self.push_files(machine, submission, testable)
                 # Run the remote worker
@@ -141,7 +165,8 @@ class WorkerProxy():
         # Create dictionary of completed test_cases
         if os.path.isfile('test_cases'):
             with open('test_cases') as fp:
-                results = {int(x[0]): x[1] for x in json.load(fp).items()}
+                results = {int(test_case_id): result for test_case_id, result
+                           in json.load(fp).items()}
         else:
             results = {}
 
@@ -151,14 +176,26 @@ class WorkerProxy():
 
         points = 0
 
-        # Set or update relevant test case results
-        for test_case in testable.test_cases:
-            test_case_result = TestCaseResult.fetch_by_ids(submission.id,
-                                                           test_case.id)
-            if test_case.id not in results:
-                if test_case_result:  # Delete existing result
-                    Session.delete(test_case_result)
-            else:
+        # Fetch the existing results for every test case in a single query
+        existing = {x.test_case_id: x for x in Session.query(TestCaseResult)
+                    .filter(TestCaseResult.submission_id == submission.id)
+                    .filter(TestCaseResult.test_case_id.in_(
+                        [x.id for x in testable.test_cases]))}
+
+        # List the output files once rather than stat each test case's
+        present = set(os.listdir('.'))
+
+        # Set or update relevant test case results. Autoflush is suspended so
+        # that the File lookups do not flush after every new result; pending
+        # results are written together at the next flush (only storing a new
+        # File forces one earlier).
+        with Session.no_autoflush:
+            for test_case in testable.test_cases:
+                test_case_result = existing.get(test_case.id)
+                if test_case.id not in results:
+                    if test_case_result:  # Delete existing result
+                        Session.delete(test_case_result)
+                    continue
                 if test_case_result:
                     test_case_result.update(results[test_case.id])
                 else:
@@ -167,18 +204,21 @@ class WorkerProxy():
                     test_case_result = TestCaseResult(**results[test_case.id])
                     Session.add(test_case_result)
                 output_file = 'tc_{0}'.format(test_case.id)
+                if output_file not in present:
+                    output_file = None
                 if test_case.output_type == 'diff':
                     matches = compute_diff(test_case, test_case_result,
                                            output_file, self.base_file_path)
                     if matches and test_case_result.status == 'success':
                         points += test_case.points
-                else:
-                    if os.path.isfile(output_file):  # Store file as the diff
+                elif output_file:  # Store file as the diff
+                    with open(output_file, 'rb') as fp:
                         test_case_result.diff = File.fetch_or_create(
-                            open(output_file).read(), self.base_file_path)
+                            fp, self.base_file_path)
 
         # Create or update Testable
-        testable_data = json.load(open('testable'))
+        with open('testable') as fp:
+            testable_data = json.load(fp)
         TestableResult.fetch_or_create(
             make_results=testable_data.get('make'), points=points,
             status=testable_data['status'], testable=testable,
@@ -189,7 +229,7 @@ class WorkerProxy():
         start = time.time()
         try:
             self.ssh(machine, 'killall -9 -u {}'.format(self.account),
-                     timeout=1)
+                     timeout=1, multiplex=False)
             raise Exception('killall did not work as expected')
         except subprocess.CalledProcessError as exc:
             if exc.returncode != 255 or exc.output.strip() != expected:
@@ -198,15 +238,23 @@ class WorkerProxy():
         return time.time() - start
 
     def push_files(self, machine, submission, testable):
-        submitted = {x.filename: x.file.sha1 for x in submission.files}
-        build_files = {x.filename: x.file.sha1 for x in testable.build_files}
+        file_path = partial(File.file_path, self.base_file_path)
+        # Fetch the (filename, sha1) pairs without loading each File
+        submitted = dict(Session.query(SubmissionToFile.filename, File.sha1)
+                         .select_from(SubmissionToFile)
+                         .join(File, SubmissionToFile.file_id == File.id)
+                         .filter(SubmissionToFile.submission_id ==
+                                 submission.id))
+        build_files = dict(Session.query(BuildFile.filename, File.sha1)
+                           .join(BuildFile.file)
+                           .join(BuildFile.testables)
+                           .filter(Testable.id == testable.id))
 
         # Prepare build directory by symlinking the relevant submission files
         os.mkdir('src')
         for filev in testable.file_verifiers:
             if filev.filename in submitted:
-                source = File.file_path(self.base_file_path,
-                                        submitted[filev.filename])
+                source = file_path(submitted[filev.filename])
                 os.symlink(source, os.path.join('src', filev.filename))
                 if filev.filename in build_files:
                     del build_files[filev.filename]
@@ -214,41 +262,37 @@ class WorkerProxy():
                 raise HandledError('File verifier not satisfied: {0}'
                                    .format(filev.filename))
         for name, sha1 in build_files.items():  # Symlink remaining build files
-            source = File.file_path(self.base_file_path, sha1)
+            source = file_path(sha1)
             os.symlink(source, os.path.join('src', name))
 
         # Symlink Makefile to current directory if necessary
         if submission.project.makefile and testable.make_target:
-            source = File.file_path(self.base_file_path,
-                                    submission.project.makefile.sha1)
+            source = file_path(submission.project.makefile.sha1)
             os.symlink(source, 'Makefile')
 
         # Symlink test inputs and copy build test case specifications
         os.mkdir('inputs')
         test_cases = []
+        inputs = set()
         for test_case in testable.test_cases:
             test_cases.append(test_case.serialize())
-            if test_case.stdin:
+            if test_case.stdin and test_case.stdin.sha1 not in inputs:
+                inputs.add(test_case.stdin.sha1)
                 destination = os.path.join('inputs', test_case.stdin.sha1)
-                if not os.path.isfile(destination):
-                    source = File.file_path(self.base_file_path,
-                                            test_case.stdin.sha1)
-                    os.symlink(source, destination)
+                os.symlink(file_path(test_case.stdin.sha1), destination)
 
         # Copy execution files
         os.mkdir('execution_files')
         for execution_file in testable.execution_files:
             destination = os.path.join('execution_files',
                                        execution_file.filename)
-            source = File.file_path(self.base_file_path,
-                                    execution_file.file.sha1)
+            source = file_path(execution_file.file.sha1)
             os.symlink(source, destination)
         # Symlink sumbitted files that should be in the execution environment
         for filev in testable.file_verifiers:
             if filev.copy_to_execution and filev.filename in submitted:
                 destination = os.path.join('execution_files', filev.filename)
-                source = File.file_path(self.base_file_path,
-                                        submitted[filev.filename])
+                source = file_path(submitted[filev.filename])
                 os.symlink(source, destination)
 
         # Generate data dictionary
@@ -269,16 +313,40 @@ class WorkerProxy():
         dst = '.'
         if from_local:
             src, dst = dst, src
-        cmd = ('rsync -e \'ssh -i {}\' --timeout=16 --delete -rLpv {} {}'
-               .format(self.private_key_file, src, dst))
-        subprocess.check_call(cmd, stdout=open(os.devnull, 'w'), shell=True)
-
-    def ssh(self, machine, command, timeout=None):
-        options = '-o ConnectTimeout={}'.format(timeout) if timeout else ''
-        cmd = 'ssh -i {key} {options} {user}@{host} {command}'.format(
-            key=self.private_key_file, user=self.account, host=machine,
-            command=command, options=options)
-        proc = subprocess.Popen(cmd, shell=True, stderr=subprocess.PIPE,
+        ssh = 'ssh -i {} -o ControlPath={}'.format(self.private_key_file,
+                                                   CONTROL_PATH)
+        cmd = ['rsync', '-e', ssh, '--timeout=16', '--delete', '-rLpv', src,
+               dst]
+        subprocess.check_call(cmd, stdout=open(os.devnull, 'w'))
+
+    def start_master(self, machine):
+        """Start a background ssh connection for later commands to share.
+
+        `kill_processes` terminates any previous master along with the rest of
+        the account's processes, so this is called after each kill.
+
+        Return whether or not the master started. When it did not, later
+        commands fall back to opening their own connections.
+
+        """
+        control_dir = os.path.dirname(CONTROL_PATH)
+        if not os.path.isdir(control_dir):
+            os.makedirs(control_dir, 0o700)
+        cmd = ['ssh', '-i', self.private_key_file,
+               '-o', 'ControlPath={}'.format(CONTROL_PATH),
+               '-o', 'ControlMaster=yes', '-o', 'ControlPersist=600', '-fN',
+               '{}@{}'.format(self.account, machine)]
+        devnull = open(os.devnull, 'w')
+        return subprocess.call(cmd, stdout=devnull, stderr=devnull) == 0
+
+    def ssh(self, machine, command, timeout=None, multiplex=True):
+        cmd = ['ssh', '-i', self.private_key_file]
+        if timeout:
+            cmd += ['-o', 'ConnectTimeout={}'.format(timeout)]
+        if multiplex:
+            cmd += ['-o', 'ControlPath={}'.format(CONTROL_PATH)]
+        cmd += ['{}@{}'.format(self.account, machine), command]
+        proc = subprocess.Popen(cmd, stderr=subprocess.PIPE,
                                 stdout=subprocess.PIPE)
         stdout, stderr = proc.communicate()
         if proc.returncode != 0:
@@ -1,16 +1,9 @@
 import amqp_worker
+from pyramid.settings import asbool
 from sqlalchemy import engine_from_config
 from .. import workers
 from ..models import Submission, configure_sql
 
-# Hack for old pickle files
-# TODO: Migrate this data to not use pickle
-import submit
-import sys
-sys.modules['nudibranch'] = submit
-sys.modules['nudibranch.diff_unit'] = submit.diff_unit
-sys.modules['nudibranch.models'] = submit.models
-
 
 @workers.wrapper
 def do_work(submission_id, update_project=False):
@@ -61,7 +54,9 @@ def main():
     args, settings = amqp_worker.parse_base_args(parser, 'app:main')
     workers.BASE_FILE_PATH = settings['file_directory']
 
-    engine = engine_from_config(settings, 'sqlalchemy.')
+    engine = engine_from_config(
+        settings, 'sqlalchemy.',
+        pool_pre_ping=asbool(settings.get('sqlalchemy.pool_pre_ping')))
     configure_sql(engine)
 
     worker = amqp_worker.AMQPWorker(